@@ -193,8 +193,15 @@ func (c *Client) Stream(ctx context.Context, sessionID, message string) (<-chan
 					return
 				}
 
+				// Chunks are JSON-encoded strings so they can carry newlines
+				var text string
+				if err := json.Unmarshal([]byte(data), &text); err != nil {
+					log.Debug().Err(err).Msg("Skipping malformed stream chunk")
+					continue
+				}
+
 				select {
-				case responseChan <- data:
+				case responseChan <- text:
 				case <-ctx.Done():
 					return
 				}
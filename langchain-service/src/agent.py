@@ -4,16 +4,56 @@ Supports multiple LLM providers, tools, and conversation memory.
 """
 
 import os
+import sys
+import asyncio
 from typing import AsyncGenerator
 from dataclasses import dataclass, field
+from functools import lru_cache
 
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.output_parsers import StrOutputParser
+import httpx
+from dotenv import load_dotenv
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
 from langchain_anthropic import ChatAnthropic
 from langchain_openai import ChatOpenAI
 
-from tools import get_tools, AVAILABLE_TOOLS
+from tokenizer import Tokenizer, get_tokenizer
+from tools import get_tools, get_tool_schemas, AVAILABLE_TOOLS
+
+load_dotenv()
+
+# Provider credentials are read once at startup
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Shared HTTP client for provider calls, installed by the app lifespan
+_http_client: httpx.AsyncClient | None = None
+
+
+# Appended to every agent's system prompt
+VOICE_INSTRUCTIONS = sys.intern("""
+IMPORTANT VOICE AGENT GUIDELINES:
+- Keep responses concise and conversational (1-3 sentences when possible)
+- Do NOT use emojis, special characters, or markdown formatting
+- Avoid bullet points or numbered lists - speak naturally
+- Your responses will be converted to speech, so write as you would speak
+- If you need to convey multiple points, do so in flowing sentences
+""")
+
+# Model name prefix -> provider
+_PROVIDER_BY_PREFIX = (
+    ("claude", "anthropic"),
+    ("gpt", "openai"),
+    ("o1", "openai"),
+)
+
+
+def _route(model: str) -> str | None:
+    """Get the provider serving a model, or None if it is not supported."""
+    return next(
+        (provider for prefix, provider in _PROVIDER_BY_PREFIX if model.startswith(prefix)),
+        None,
+    )
 
 
 @dataclass
@@ -25,6 +65,234 @@ class AgentConfig:
     temperature: float = 0.7
     max_tokens: int = 1024
     tools: list[str] = field(default_factory=list)
+    # Older turns are summarized once history grows past this many tokens
+    max_history_tokens: int = 8000
+    # Number of most recent messages always kept verbatim
+    compact_keep_recent: int = 8
+    # Resolved from the model name
+    provider: str = field(init=False)
+    # System prompt with voice instructions; interned so sessions with the
+    # same prompt share one string
+    full_system_prompt: str = field(init=False)
+    
+    def __post_init__(self):
+        provider = _route(self.model)
+        if provider is None:
+            raise ValueError(f"Unsupported model: {self.model}")
+        self.provider = provider
+        self.full_system_prompt = sys.intern(f"{self.system_prompt}\n\n{VOICE_INSTRUCTIONS}")
+
+
+# Anthropic prompt caching marker (OpenAI caches matching prefixes automatically)
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Cheap models used to summarize old turns, by provider
+SUMMARY_MODELS = {
+    "anthropic": "claude-3-haiku-20240307",
+    "openai": "gpt-4o-mini",
+}
+
+SUMMARY_PROMPT = """Summarize the conversation between a user and a voice assistant below.
+Keep names, numbers, order IDs, dates, decisions, and open requests.
+Write a few plain sentences with no lists or formatting."""
+
+
+def _content_text(content) -> str:
+    """Flatten message content (a string or a list of content blocks) to text."""
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in content
+    )
+
+
+def set_http_client(client: httpx.AsyncClient | None):
+    """Set the shared HTTP client used by LLM clients created from now on."""
+    global _http_client
+    _http_client = client
+    # Drop clients bound to the previous HTTP client
+    _get_llm.cache_clear()
+    _get_bound_llm.cache_clear()
+
+
+def _create_anthropic(model: str, temperature: float, max_tokens: int) -> BaseChatModel:
+    return ChatAnthropic(
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        anthropic_api_key=ANTHROPIC_API_KEY,
+    )
+
+
+def _create_openai(model: str, temperature: float, max_tokens: int) -> BaseChatModel:
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        openai_api_key=OPENAI_API_KEY,
+        http_async_client=_http_client,
+    )
+
+
+PROVIDERS = {
+    "anthropic": _create_anthropic,
+    "openai": _create_openai,
+}
+
+
+@lru_cache(maxsize=32)
+def _get_llm(provider: str, model: str, temperature: float, max_tokens: int) -> BaseChatModel:
+    """
+    Get a chat model client for the given settings.
+    Clients hold no conversation state, so sessions with the same settings
+    share one instance and its HTTP connection pool.
+    """
+    return PROVIDERS[provider](model, temperature, max_tokens)
+
+
+@lru_cache(maxsize=64)
+def _get_bound_llm(
+    provider: str,
+    model: str,
+    temperature: float,
+    max_tokens: int,
+    tool_names: tuple[str, ...],
+):
+    """
+    Get a chat model with tools bound, shared across sessions.
+    Tool schemas are sorted by name so every session sends the same tool
+    block and provider prompt caching keeps hitting.
+    """
+    llm = _get_llm(provider, model, temperature, max_tokens)
+    if not tool_names:
+        return llm
+    return llm.bind_tools(get_tool_schemas(list(tool_names)))
+
+
+class PromptBuffer:
+    """
+    Message layout that keeps the prompt prefix byte-stable across turns.
+
+    The request is always emitted as [system, *committed, *pending_tail].
+    Committed turns are never rewritten, so providers can reuse the cached
+    prefix and only the new tail has to be processed. The prefix list is
+    maintained incrementally on commit rather than rebuilt per call.
+    """
+
+    def __init__(
+        self,
+        static_system_prompt: str,
+        tokenizer: Tokenizer | None = None,
+        cache_control: bool = False,
+    ):
+        self.static_system_prompt = static_system_prompt
+        self.tokenizer = tokenizer
+        self.cache_control = cache_control
+        # Condensed form of turns dropped by compaction
+        self.summary: str | None = None
+        self.system_message = self._create_system_message()
+        self.committed_messages: list[BaseMessage] = []
+        self.pending_tail: list[BaseMessage] = []
+        self.token_estimate = 0
+        # Bumped whenever the history is cleared
+        self.generation = 0
+        # [system, *committed] as sent, with the cache breakpoint applied
+        self._prefix: list[BaseMessage] = [self.system_message]
+        self._marked_index: int | None = None
+
+    def _create_system_message(self) -> SystemMessage:
+        texts = [self.static_system_prompt]
+        if self.summary:
+            texts.append(f"Prior conversation summary: {self.summary}")
+        if not self.cache_control:
+            return SystemMessage(content="\n\n".join(texts))
+        return SystemMessage(content=[
+            {"type": "text", "text": text, "cache_control": CACHE_CONTROL}
+            for text in texts
+        ])
+
+    def begin(self, *messages: BaseMessage):
+        """Start a new turn, discarding any tail left by a failed turn."""
+        self.pending_tail = list(messages)
+
+    def append(self, *messages: BaseMessage):
+        """Add messages to the tail of the current turn."""
+        self.pending_tail.extend(messages)
+
+    def commit(self):
+        """Move the current turn into the committed prefix."""
+        self.committed_messages.extend(self.pending_tail)
+        # History is append-only, so only the new turn is tokenized
+        self.token_estimate += self._count_tokens(self.pending_tail)
+        self._prefix.extend(self.pending_tail)
+        self.pending_tail = []
+        if self.cache_control:
+            self._move_cache_breakpoint()
+
+    def build(self) -> list[BaseMessage]:
+        """Build the request messages in a fixed order."""
+        return [*self._prefix, *self.pending_tail]
+
+    def clear(self):
+        """Drop all committed and pending turns."""
+        self.summary = None
+        self.system_message = self._create_system_message()
+        self.committed_messages = []
+        self.pending_tail = []
+        self.token_estimate = 0
+        self.generation += 1
+        self._prefix = [self.system_message]
+        self._marked_index = None
+
+    def _count_tokens(self, messages: list[BaseMessage]) -> int:
+        """Token count of a run of messages."""
+        return self.tokenizer.count_messages(_content_text(msg.content) for msg in messages)
+
+    def compaction_boundary(self, keep_recent: int) -> int:
+        """
+        Number of oldest committed messages to summarize.
+        The kept tail starts at a user turn so tool call/result pairs are
+        never split.
+        """
+        for i in range(max(len(self.committed_messages) - keep_recent, 0), 0, -1):
+            if isinstance(self.committed_messages[i], HumanMessage):
+                return i
+        return 0
+
+    def compact(self, count: int, summary: str):
+        """
+        Replace the oldest `count` committed messages with a summary.
+        This is the only operation that rewrites the prefix, so the provider
+        cache is invalidated once per compaction rather than per turn.
+        """
+        self.summary = summary
+        self.system_message = self._create_system_message()
+        self.committed_messages = self.committed_messages[count:]
+        self.token_estimate = self._count_tokens(self.committed_messages)
+        self._prefix = [self.system_message, *self.committed_messages]
+        self._marked_index = None
+        if self.cache_control:
+            self._move_cache_breakpoint()
+
+    def _move_cache_breakpoint(self):
+        """Put the cache breakpoint on the last committed assistant turn."""
+        for i in range(len(self._prefix) - 1, 0, -1):
+            msg = self._prefix[i]
+            if isinstance(msg, AIMessage) and isinstance(msg.content, str) and msg.content:
+                break
+        else:
+            return
+
+        if self._marked_index is not None:
+            # Restore the plain message; _prefix[i] is committed_messages[i - 1]
+            self._prefix[self._marked_index] = self.committed_messages[self._marked_index - 1]
+        self._prefix[i] = AIMessage(content=[{
+            "type": "text",
+            "text": msg.content,
+            "cache_control": CACHE_CONTROL,
+        }])
+        self._marked_index = i
 
 
 class VoiceAgent:
@@ -37,168 +305,222 @@ class VoiceAgent:
     
     def __init__(self, config: AgentConfig):
         self.config = config
-        self.messages: list = []
-        self.llm = self._create_llm()
-        self.tools = get_tools(config.tools) if config.tools else []
-        self.chain = self._create_chain()
+        self.tools = get_tools(config.tools)
+        self._tool_by_name = {tool.name: tool for tool in self.tools}
+        # Sessions with the same key share a model client
+        self._llm_key = (
+            config.provider,
+            config.model,
+            config.temperature,
+            config.max_tokens,
+            tuple(sorted(self._tool_by_name)),
+        )
+        # API view of the history, kept in step with committed turns
+        self._history_dicts: list[dict] = []
+        self._lock = asyncio.Lock()
+        self._compaction_task: asyncio.Task | None = None
+        self.buffer = PromptBuffer(
+            config.full_system_prompt,
+            cache_control=config.provider == "anthropic",
+        )
+        # Model clients and the tokenizer are resolved by ensure_ready()
+        self.llm = None
+        self._summarizer = None
+        self._ready = False
+        self._ready_lock = asyncio.Lock()
     
-    def _create_llm(self):
-        """Create the appropriate LLM based on model name."""
-        model = self.config.model
-        
-        if model.startswith("claude"):
-            return ChatAnthropic(
-                model=model,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
-            )
-        elif model.startswith("gpt") or model.startswith("o1"):
-            return ChatOpenAI(
-                model=model,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                openai_api_key=os.getenv("OPENAI_API_KEY"),
-            )
-        else:
-            # Default to Claude
-            return ChatAnthropic(
-                model="claude-3-haiku-20240307",
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
+    async def ensure_ready(self):
+        """Resolve model clients and the tokenizer, off the event loop."""
+        if self._ready:
+            return
+        async with self._ready_lock:
+            if self._ready:
+                return
+            self.llm, self._summarizer, self.buffer.tokenizer = await asyncio.to_thread(
+                self._load_clients
             )
+            self._ready = True
     
-    def _create_chain(self):
-        """Create the LangChain chain with prompt template."""
-        # Add voice-specific instructions to system prompt
-        voice_instructions = """
-IMPORTANT VOICE AGENT GUIDELINES:
-- Keep responses concise and conversational (1-3 sentences when possible)
-- Do NOT use emojis, special characters, or markdown formatting
-- Avoid bullet points or numbered lists - speak naturally
-- Your responses will be converted to speech, so write as you would speak
-- If you need to convey multiple points, do so in flowing sentences
-"""
-        
-        full_system_prompt = f"{self.config.system_prompt}\n\n{voice_instructions}"
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", full_system_prompt),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}"),
-        ])
-        
-        # Bind tools if available
-        if self.tools:
-            llm_with_tools = self.llm.bind_tools(self.tools)
-            return prompt | llm_with_tools
-        
-        return prompt | self.llm | StrOutputParser()
+    def _load_clients(self) -> tuple:
+        """Build (or fetch cached) model clients; runs in a worker thread."""
+        # Buffered messages go straight to the model, no prompt template
+        llm = _get_bound_llm(*self._llm_key)
+        summarizer = _get_llm(self.config.provider, SUMMARY_MODELS[self.config.provider], 0.0, 512)
+        return llm, summarizer, get_tokenizer(self.config.provider)
+    
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """Committed conversation history."""
+        return self.buffer.committed_messages
     
     async def chat(self, message: str) -> tuple[str, list[dict] | None]:
         """
         Send a message and get a complete response.
         Returns (response_text, tool_calls)
         """
-        # Add user message to history
-        self.messages.append(HumanMessage(content=message))
-        
-        # Get response
-        response = await self.chain.ainvoke({
-            "history": self.messages[:-1],  # Exclude current message
-            "input": message,
-        })
-        
-        # Handle tool calls if present
-        tool_calls = None
-        if hasattr(response, 'tool_calls') and response.tool_calls:
-            tool_calls = await self._handle_tool_calls(response.tool_calls)
-            # Get final response after tool execution
-            response = await self.chain.ainvoke({
-                "history": self.messages,
-                "input": f"Tool results: {tool_calls}. Please provide your response.",
-            })
-        
-        # Extract text content
-        if hasattr(response, 'content'):
-            response_text = response.content
-        else:
-            response_text = str(response)
-        
-        # Add assistant message to history
-        self.messages.append(AIMessage(content=response_text))
-        
-        return response_text, tool_calls
+        # Serialize turns so concurrent requests can't interleave history
+        async with self._lock:
+            await self.ensure_ready()
+            
+            # Only the new user turn is appended after the cached prefix
+            self.buffer.begin(HumanMessage(content=message))
+            
+            # Get response
+            response = await self.llm.ainvoke(self.buffer.build())
+            
+            # Handle tool calls if present
+            tool_calls = None
+            if hasattr(response, 'tool_calls') and response.tool_calls:
+                tool_calls = await self._handle_tool_calls(response.tool_calls)
+                # Continue the same message list with tool results so the
+                # provider reuses the prefix from the first call
+                self.buffer.append(response, *(
+                    ToolMessage(
+                        content=str(result.get("result", result.get("error"))),
+                        tool_call_id=tool_call["id"],
+                        status="error" if "error" in result else "success",
+                    )
+                    for tool_call, result in zip(response.tool_calls, tool_calls)
+                ))
+                response = await self.llm.ainvoke(self.buffer.build())
+            
+            response_text = _content_text(response.content)
+            
+            self._commit_turn(message, response_text)
+            
+            return response_text, tool_calls
     
-    async def stream(self, message: str) -> AsyncGenerator[str, None]:
+    async def stream(
+        self,
+        message: str,
+        delivered: list[str] | None = None,
+    ) -> AsyncGenerator[str, None]:
         """
         Send a message and stream the response.
-        Yields text chunks as they're generated.
+        Yields text chunks as they're generated. If the stream is cancelled
+        or closed early (e.g. the client disconnected), the assistant's turn
+        keeps only what reached the user: the chunks the caller recorded in
+        `delivered`, or every chunk yielded when `delivered` is not given.
         """
-        # Add user message to history
-        self.messages.append(HumanMessage(content=message))
-        
-        full_response = ""
+        async with self._lock:
+            await self.ensure_ready()
+            self.buffer.begin(HumanMessage(content=message))
+            
+            full_response = ""
+            
+            try:
+                async for chunk in self.llm.astream(self.buffer.build()):
+                    text = _content_text(chunk.content)
+                    if text:
+                        full_response += text
+                        yield text
+            except (asyncio.CancelledError, GeneratorExit):
+                if delivered is not None:
+                    full_response = "".join(delivered)
+                # Empty assistant turns are rejected by Anthropic
+                if full_response:
+                    self._commit_turn(message, full_response)
+                raise
+            
+            if full_response:
+                self._commit_turn(message, full_response)
+    
+    def _commit_turn(self, message: str, response_text: str):
+        """Commit the current turn so the next call sees it as part of the prefix."""
+        self.buffer.append(AIMessage(content=response_text))
+        self.buffer.commit()
+        self._history_dicts.append({"role": "user", "content": message})
+        self._history_dicts.append({"role": "assistant", "content": response_text})
         
-        async for chunk in self.chain.astream({
-            "history": self.messages[:-1],
-            "input": message,
-        }):
-            # Handle different chunk types
-            if hasattr(chunk, 'content'):
-                text = chunk.content
-            elif isinstance(chunk, str):
-                text = chunk
-            else:
-                continue
+        if (
+            self.buffer.token_estimate > self.config.max_history_tokens
+            and self._compaction_task is None
+        ):
+            # Summarize off the hot path; the reply is not held up
+            self._compaction_task = asyncio.create_task(self._compact_history())
+    
+    async def _compact_history(self):
+        """Summarize the oldest turns into the system prompt."""
+        try:
+            buffer = self.buffer
+            generation = buffer.generation
+            count = buffer.compaction_boundary(self.config.compact_keep_recent)
+            if count == 0:
+                return
             
-            if text:
-                full_response += text
-                yield text
+            summary = await self._summarize(buffer.committed_messages[:count])
+            
+            async with self._lock:
+                # Turns are only ever appended, so the first `count` messages
+                # are unchanged unless the history was cleared meanwhile
+                if buffer.generation == generation:
+                    buffer.compact(count, summary)
+        except Exception as e:
+            print(f"⚠️ History compaction failed: {e}")
+        finally:
+            self._compaction_task = None
+    
+    async def _summarize(self, messages: list[BaseMessage]) -> str:
+        """Summarize messages (and any earlier summary) with a cheap model."""
+        lines = []
+        if self.buffer.summary:
+            lines.append(f"Earlier summary: {self.buffer.summary}")
+        for msg in messages:
+            text = _content_text(msg.content)
+            if not text:
+                continue
+            if isinstance(msg, HumanMessage):
+                lines.append(f"User: {text}")
+            elif isinstance(msg, ToolMessage):
+                lines.append(f"Tool result: {text}")
+            else:
+                lines.append(f"Assistant: {text}")
         
-        # Add assistant message to history
-        self.messages.append(AIMessage(content=full_response))
+        response = await self._summarizer.ainvoke([
+            SystemMessage(content=SUMMARY_PROMPT),
+            HumanMessage(content="\n".join(lines)),
+        ])
+        return _content_text(response.content)
     
     async def _handle_tool_calls(self, tool_calls: list) -> list[dict]:
-        """Execute tool calls and return results."""
-        results = []
+        """Execute tool calls concurrently and return one result per call, in order."""
+        return await asyncio.gather(*(self._run_tool_call(tc) for tc in tool_calls))
+    
+    async def _run_tool_call(self, tool_call: dict) -> dict:
+        """Execute a single tool call, capturing errors in the result."""
+        tool_name = tool_call.get("name")
+        tool_args = tool_call.get("args", {})
         
-        for tool_call in tool_calls:
-            tool_name = tool_call.get("name")
-            tool_args = tool_call.get("args", {})
-            
-            # Find and execute the tool
-            for tool in self.tools:
-                if tool.name == tool_name:
-                    try:
-                        result = await tool.ainvoke(tool_args)
-                        results.append({
-                            "tool": tool_name,
-                            "args": tool_args,
-                            "result": result,
-                        })
-                    except Exception as e:
-                        results.append({
-                            "tool": tool_name,
-                            "args": tool_args,
-                            "error": str(e),
-                        })
-                    break
+        tool = self._tool_by_name.get(tool_name)
+        if tool is None:
+            # Every tool call needs a result for the continuation call
+            return {
+                "tool": tool_name,
+                "args": tool_args,
+                "error": f"Unknown tool: {tool_name}",
+            }
         
-        return results
+        try:
+            result = await tool.ainvoke(tool_args)
+            return {
+                "tool": tool_name,
+                "args": tool_args,
+                "result": result,
+            }
+        except Exception as e:
+            return {
+                "tool": tool_name,
+                "args": tool_args,
+                "error": str(e),
+            }
     
     def get_history(self) -> list[dict]:
         """Get conversation history as a list of dicts."""
-        return [
-            {
-                "role": "user" if isinstance(msg, HumanMessage) else "assistant",
-                "content": msg.content,
-            }
-            for msg in self.messages
-        ]
+        # Tool call/result turns are kept in the prefix but not shown
+        return list(self._history_dicts)
     
     def clear_history(self):
         """Clear conversation history."""
-        self.messages = []
+        self.buffer.clear()
+        self._history_dicts = []
 
@@ -5,38 +5,73 @@ A dedicated Python microservice for LangChain agent processing.
 
 import os
 import asyncio
-from typing import AsyncGenerator
+import inspect
+from typing import AsyncGenerator, AsyncIterable
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import serialize_response
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
-from agent import VoiceAgent, AgentConfig
+from agent import VoiceAgent, AgentConfig, set_http_client
 
 load_dotenv()
 
-# Store active agents
-agents: dict[str, VoiceAgent] = {}
+# Store active agents, bounded in size and expired after an hour idle
+agents: TTLCache[str, VoiceAgent] = TTLCache(maxsize=10_000, ttl=3600)
+
+# Keeps fire-and-forget tasks referenced until they finish
+background_tasks: set[asyncio.Task] = set()
+
+# SSE frames are flushed once this many characters are buffered, or once the
+# oldest buffered chunk has waited this long (seconds)
+SSE_FLUSH_CHARS = 64
+SSE_FLUSH_INTERVAL = 0.02
+
+# How often a streaming request checks whether its client went away (seconds)
+DISCONNECT_POLL_INTERVAL = 0.05
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager."""
     print("🚀 LangChain Voice Agent Service starting...")
+    # One long-lived HTTP/2 client so provider calls share warm connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=60,
+    )
+    set_http_client(app.state.http)
     yield
     # Cleanup
     agents.clear()
+    set_http_client(None)
+    await app.state.http.aclose()
     print("👋 LangChain Voice Agent Service shutting down...")
 
 
+# Recent FastAPI serializes declared response models straight to JSON bytes
+# through Pydantic. Older releases build a dict and json.dumps it, so render
+# with orjson there; a custom response class would disable the fast path
+_app_options = (
+    {}
+    if "dump_json" in inspect.signature(serialize_response).parameters
+    else {"default_response_class": ORJSONResponse}
+)
+
 app = FastAPI(
     title="LangChain Voice Agent Service",
     description="Microservice for LangChain-powered voice agent processing",
     version="1.0.0",
     lifespan=lifespan,
+    **_app_options,
 )
 
 # CORS
@@ -60,6 +95,8 @@ class CreateAgentRequest(BaseModel):
     temperature: float = 0.7
     max_tokens: int = 1024
     tools: list[str] | None = None  # Tool names to enable
+    max_history_tokens: int = Field(8000, gt=0)
+    compact_keep_recent: int = Field(8, ge=0)
 
 
 class ChatRequest(BaseModel):
@@ -81,15 +118,135 @@ class StreamRequest(BaseModel):
     message: str
 
 
+# Declared response models validate and document each response and let
+# FastAPI serialize it without the generic JSON encoder (see _app_options)
+
+class HealthResponse(BaseModel):
+    """Service health status."""
+    status: str
+    service: str
+
+
+class CreateAgentResponse(BaseModel):
+    """Response after creating an agent session."""
+    session_id: str
+    status: str
+    greeting: str | None = None
+
+
+class DeleteAgentResponse(BaseModel):
+    """Response after deleting an agent session."""
+    status: str
+    session_id: str
+
+
+class HistoryResponse(BaseModel):
+    """Conversation history for an agent session."""
+    session_id: str
+    messages: list[dict[str, str]]
+
+
+# ==================== Sessions ====================
+
+def get_agent(session_id: str) -> VoiceAgent:
+    """Look up an agent session and refresh its expiry."""
+    agent = agents.get(session_id)
+    if not agent:
+        raise HTTPException(status_code=404, detail="Agent session not found")
+    # TTLCache expires by insertion time, so re-insert to keep active sessions
+    agents[session_id] = agent
+    return agent
+
+
+def _report_setup_failure(task: asyncio.Task):
+    """Log a failed background agent setup; the next turn retries it."""
+    if not task.cancelled() and task.exception() is not None:
+        print(f"⚠️ Agent setup failed: {task.exception()}")
+
+
+# ==================== Streaming ====================
+
+async def coalesce(
+    chunks: AsyncIterable[str],
+    min_chars: int = SSE_FLUSH_CHARS,
+    max_delay: float = SSE_FLUSH_INTERVAL,
+    stop: asyncio.Event | None = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Merge small text chunks into larger ones.
+    A merged chunk is emitted once it holds `min_chars` characters or its
+    first chunk is `max_delay` seconds old, whichever comes first.
+    Setting `stop` cancels the source mid-read and ends the output after
+    the chunks received so far.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    
+    async def produce():
+        # Drain the source in a single task so the generator is never
+        # resumed across tasks
+        try:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            # Also reached when `stop` cancels the source
+            queue.put_nowait(done)
+    
+    producer = asyncio.create_task(produce())
+    stopper = None
+    if stop is not None:
+        stopper = asyncio.create_task(stop.wait())
+        stopper.add_done_callback(lambda _: producer.cancel())
+    loop = asyncio.get_running_loop()
+    buf: list[str] = []
+    size = 0
+    deadline = 0.0
+    
+    try:
+        while True:
+            try:
+                timeout = max(deadline - loop.time(), 0) if buf else None
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+            
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                if buf:
+                    yield "".join(buf)
+                raise item
+            if item:
+                if not buf:
+                    deadline = loop.time() + max_delay
+                buf.append(item)
+                size += len(item)
+                if size < min_chars and loop.time() < deadline:
+                    continue
+            
+            if buf:
+                yield "".join(buf)
+                buf, size = [], 0
+        
+        if buf:
+            yield "".join(buf)
+    finally:
+        producer.cancel()
+        if stopper is not None:
+            stopper.cancel()
+
+
 # ==================== Endpoints ====================
 
-@app.get("/health")
+@app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint."""
     return {"status": "healthy", "service": "langchain-voice-agent"}
 
 
-@app.post("/agents/create")
+@app.post("/agents/create", response_model=CreateAgentResponse)
 async def create_agent(request: CreateAgentRequest):
     """Create a new agent session."""
     try:
@@ -100,16 +257,26 @@ async def create_agent(request: CreateAgentRequest):
             temperature=request.temperature,
             max_tokens=request.max_tokens,
             tools=request.tools or [],
+            max_history_tokens=request.max_history_tokens,
+            compact_keep_recent=request.compact_keep_recent,
         )
         
         agent = VoiceAgent(config)
         agents[request.session_id] = agent
         
+        # Resolve model clients in the background so this returns right away
+        task = asyncio.create_task(agent.ensure_ready())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        task.add_done_callback(_report_setup_failure)
+        
         return {
             "session_id": request.session_id,
             "status": "created",
             "greeting": request.greeting,
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -117,9 +284,7 @@ async def create_agent(request: CreateAgentRequest):
 @app.post("/agents/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Send a message and get a complete response."""
-    agent = agents.get(request.session_id)
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agent session not found")
+    agent = get_agent(request.session_id)
     
     try:
         response, tool_calls = await agent.chat(request.message)
@@ -133,19 +298,32 @@ async def chat(request: ChatRequest):
 
 
 @app.post("/agents/stream")
-async def stream_chat(request: StreamRequest):
+async def stream_chat(request: StreamRequest, http_request: Request):
     """Send a message and get a streaming response."""
-    agent = agents.get(request.session_id)
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agent session not found")
+    agent = get_agent(request.session_id)
+    disconnected = asyncio.Event()
+    
+    async def watch_disconnect():
+        # Users barge in often; stop generating as soon as the client leaves
+        while not await http_request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        disconnected.set()
     
-    async def generate() -> AsyncGenerator[str, None]:
+    async def generate() -> AsyncGenerator[bytes | str, None]:
+        watcher = asyncio.create_task(watch_disconnect())
+        # Chunks already sent, kept as the reply if the turn is cut short
+        delivered: list[str] = []
         try:
-            async for chunk in agent.stream(request.message):
-                yield f"data: {chunk}\n\n"
+            async for chunk in coalesce(agent.stream(request.message, delivered), stop=disconnected):
+                # JSON-encode so newlines inside a chunk can't break SSE framing
+                yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+                # Resumed only once the frame has been sent to the client
+                delivered.append(chunk)
             yield "data: [DONE]\n\n"
         except Exception as e:
             yield f"data: [ERROR] {str(e)}\n\n"
+        finally:
+            watcher.cancel()
     
     return StreamingResponse(
         generate(),
@@ -157,7 +335,7 @@ async def stream_chat(request: StreamRequest):
     )
 
 
-@app.delete("/agents/{session_id}")
+@app.delete("/agents/{session_id}", response_model=DeleteAgentResponse)
 async def delete_agent(session_id: str):
     """Delete an agent session."""
     if session_id in agents:
@@ -166,12 +344,10 @@ async def delete_agent(session_id: str):
     raise HTTPException(status_code=404, detail="Agent session not found")
 
 
-@app.get("/agents/{session_id}/history")
+@app.get("/agents/{session_id}/history", response_model=HistoryResponse)
 async def get_history(session_id: str):
     """Get conversation history for an agent."""
-    agent = agents.get(session_id)
-    if not agent:
-        raise HTTPException(status_code=404, detail="Agent session not found")
+    agent = get_agent(session_id)
     
     return {
         "session_id": session_id,
@@ -187,6 +363,7 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=port,
+        loop="uvloop",
         reload=os.getenv("ENV", "development") == "development",
     )
 
@@ -0,0 +1,83 @@
+"""
+Token Counting
+Cached token counts for prompts and conversation history.
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Iterable
+
+import tiktoken
+
+# Encoding used to count tokens for OpenAI models
+OPENAI_ENCODING = "o200k_base"
+
+
+class HeuristicTokenizer:
+    """
+    Rough token counter (about 4 characters per token).
+    Counting is just `len()`, so it is not cached.
+    """
+
+    @staticmethod
+    def count(text: str) -> int:
+        """Count tokens in a single text."""
+        return len(text) // 4
+
+    @staticmethod
+    def count_messages(texts: Iterable[str]) -> int:
+        """Count tokens across a sequence of message texts."""
+        return sum(len(text) // 4 for text in texts)
+
+
+class TokenizerCache:
+    """
+    LRU cache in front of a token counter.
+
+    Maps an exact text to its token count. System prompts, greetings and
+    tool results repeat across sessions and turns, so they are counted once.
+    Conversation history is counted incrementally by its owner, one new
+    turn at a time, so it does not need a cache of its own.
+    """
+
+    def __init__(self, count: Callable[[str], int], maxsize: int = 256):
+        self._count = count
+        self._cache: OrderedDict[str, int] = OrderedDict()
+        self._maxsize = maxsize
+
+    def count(self, text: str) -> int:
+        """Count tokens in a single text."""
+        n = self._cache.get(text)
+        if n is not None:
+            self._cache.move_to_end(text)
+            return n
+
+        n = self._count(text)
+        self._cache[text] = n
+        if len(self._cache) > self._maxsize:
+            self._cache.popitem(last=False)
+        return n
+
+    def count_messages(self, texts: Iterable[str]) -> int:
+        """Count tokens across a sequence of message texts."""
+        return sum(self.count(text) for text in texts)
+
+
+Tokenizer = TokenizerCache | HeuristicTokenizer
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(provider: str) -> Tokenizer:
+    """
+    Get the shared tokenizer for a provider.
+    Anthropic does not publish a local tokenizer, so Claude models use the
+    character heuristic. OpenAI models use a cached tiktoken counter when
+    its encoding is available and fall back to the heuristic otherwise.
+    """
+    if provider == "openai":
+        try:
+            encoding = tiktoken.get_encoding(OPENAI_ENCODING)
+            return TokenizerCache(lambda text: len(encoding.encode_ordinary(text)))
+        except Exception as e:
+            print(f"⚠️ tiktoken encoding unavailable, estimating tokens: {e}")
+    return HeuristicTokenizer()
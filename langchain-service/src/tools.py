@@ -3,9 +3,83 @@ LangChain Tools for Voice Agents
 Define custom tools that agents can use during conversations.
 """
 
+import ast
+import math
+import operator
+from types import MappingProxyType
 from typing import Optional
 from datetime import datetime
+from functools import lru_cache
 from langchain_core.tools import tool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+# ==================== Expression Evaluation ====================
+
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_UNARY_OPS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant,
+    *_BINARY_OPS, *_UNARY_OPS,
+)
+
+# Keeps inputs like "9 ** 9 ** 9" or "(9 ** 999) ** 999" from hanging the worker
+_MAX_RESULT_BITS = 10_000
+
+
+def _bits(value) -> float:
+    """Size of a number's magnitude in bits (log2 of its absolute value)."""
+    return math.log2(abs(value)) if value else 0.0
+
+
+def _eval_binop(node: ast.BinOp):
+    left, right = _eval_node(node.left), _eval_node(node.right)
+    # Estimate the result size before computing it
+    if isinstance(node.op, ast.Pow):
+        if right > 0 and right * _bits(left) > _MAX_RESULT_BITS:
+            raise ValueError("result too large")
+    elif isinstance(node.op, ast.Mult):
+        if _bits(left) + _bits(right) > _MAX_RESULT_BITS:
+            raise ValueError("result too large")
+    return _BINARY_OPS[type(node.op)](left, right)
+
+
+_EVALUATORS = {
+    ast.Constant: lambda node: node.value,
+    ast.BinOp: _eval_binop,
+    ast.UnaryOp: lambda node: _UNARY_OPS[type(node.op)](_eval_node(node.operand)),
+}
+
+
+def _eval_node(node: ast.expr):
+    return _EVALUATORS[type(node)](node)
+
+
+@lru_cache(maxsize=1024)
+def _parse_expression(expression: str) -> ast.expr:
+    """Parse and validate an arithmetic expression."""
+    tree = ast.parse(expression, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError("Invalid characters in expression")
+        if isinstance(node, ast.Constant) and (
+            isinstance(node.value, bool) or not isinstance(node.value, (int, float))
+        ):
+            raise ValueError("Invalid characters in expression")
+    return tree.body
 
 
 # ==================== General Tools ====================
@@ -26,12 +100,16 @@ def calculate(expression: str) -> str:
         expression: A mathematical expression to evaluate (e.g., "2 + 2", "100 * 0.15")
     """
     try:
-        # Safe evaluation of mathematical expressions
-        allowed_chars = set("0123456789+-*/.() ")
-        if not all(c in allowed_chars for c in expression):
-            return "Error: Invalid characters in expression"
-        
-        result = eval(expression)
+        # Only numbers and arithmetic operators are accepted
+        node = _parse_expression(expression)
+    except (SyntaxError, ValueError):
+        return "Error: Invalid characters in expression"
+    except (RecursionError, MemoryError):
+        # Deeply nested input overflows the parser itself
+        return "Error: Expression is too complex"
+    
+    try:
+        result = _eval_node(node)
         return f"The result of {expression} is {result}"
     except Exception as e:
         return f"Error calculating: {str(e)}"
@@ -217,29 +295,36 @@ def get_menu_info(category: Optional[str] = None) -> str:
 
 # ==================== Tool Registry ====================
 
-AVAILABLE_TOOLS = {
+# Read-only name -> tool map, built once at import
+AVAILABLE_TOOLS = MappingProxyType({t.name: t for t in (
     # General
-    "get_current_time": get_current_time,
-    "calculate": calculate,
+    get_current_time,
+    calculate,
     
     # Customer Support
-    "check_order_status": check_order_status,
-    "create_support_ticket": create_support_ticket,
+    check_order_status,
+    create_support_ticket,
     
     # Sales
-    "check_product_availability": check_product_availability,
-    "get_pricing": get_pricing,
-    "schedule_demo": schedule_demo,
+    check_product_availability,
+    get_pricing,
+    schedule_demo,
     
     # Healthcare
-    "check_appointment_availability": check_appointment_availability,
-    "book_appointment": book_appointment,
+    check_appointment_availability,
+    book_appointment,
     
     # Restaurant
-    "check_reservation_availability": check_reservation_availability,
-    "make_reservation": make_reservation,
-    "get_menu_info": get_menu_info,
-}
+    check_reservation_availability,
+    make_reservation,
+    get_menu_info,
+)})
+
+# Tool schemas, generated once at import. Both providers accept the
+# OpenAI function format in bind_tools, so sessions skip schema reflection.
+TOOL_SCHEMAS = MappingProxyType(
+    {name: convert_to_openai_tool(t) for name, t in AVAILABLE_TOOLS.items()}
+)
 
 # Tool sets by industry
 INDUSTRY_TOOLS = {
@@ -250,12 +335,20 @@ INDUSTRY_TOOLS = {
 }
 
 
-def get_tools(tool_names: list[str]) -> list:
+def get_tools(tool_names: list[str]) -> tuple:
     """Get tool instances by name."""
-    return [AVAILABLE_TOOLS[name] for name in tool_names if name in AVAILABLE_TOOLS]
+    return tuple(
+        t for name in tool_names
+        if (t := AVAILABLE_TOOLS.get(name)) is not None
+    )
+
+
+def get_tool_schemas(tool_names: list[str]) -> list[dict]:
+    """Get pre-built tool schemas by name, in a stable (sorted) order."""
+    return [TOOL_SCHEMAS[name] for name in sorted(set(tool_names)) if name in TOOL_SCHEMAS]
 
 
-def get_tools_for_industry(industry_slug: str) -> list:
+def get_tools_for_industry(industry_slug: str) -> tuple:
     """Get tools appropriate for an industry."""
     tool_names = INDUSTRY_TOOLS.get(industry_slug, ["get_current_time"])
     return get_tools(tool_names)